@@ -2,11 +2,16 @@ import streamlit as st
 import uuid
 import os
 import datetime
+import time
+import logging
 from dotenv import load_dotenv
 from openai import OpenAI
 from anthropic import Anthropic
-from utils import save_chats, load_chats, get_chat_title_from_content, format_timestamp
-from error_handler import handle_error, api_error_handler, APIError, ModelNotAvailableError
+from utils import get_chat_title_from_content, format_timestamp, chat_matches_search
+from state_store import load_chats, load_chat, save_chat, update_chat, chats_version
+from maintenance import register_task, submit_task, mark_chat_active
+from router import AUTO_MODEL, classify_prompt, route_prompt, escalation_for, needs_escalation, is_error_response, record_latency, latency_saved
+from error_handler import handle_error, api_error_handler, log_event, APIError, ModelNotAvailableError
 
 # Load environment variables
 load_dotenv()
@@ -29,12 +34,18 @@ except Exception as e:
 
 # Import authentication
 try:
-    from auth_config import check_password, set_usage_quota
+    from auth_config import check_password, set_usage_quota, record_api_call, get_usage_key, is_within_quota
     auth_enabled = True
 except ImportError:
     auth_enabled = False
     def set_usage_quota():
         return True
+    def record_api_call(usage_key=None):
+        pass
+    def get_usage_key():
+        return None
+    def is_within_quota(usage_key):
+        return True
 
 # Set page configuration
 st.set_page_config(
@@ -214,12 +225,19 @@ MODELS = {
     "OpenAI o1-mini": {"provider": "openai", "model": "o1-mini"},           
     "OpenAI gpt-4o": {"provider": "openai", "model": "gpt-4o"}, 
     "Anthropic claude-3-7-sonnet-20250219": {"provider": "anthropic", "model": "claude-3-7-sonnet-20250219"},
-    "OpenAI o1": {"provider": "openai", "model": "o1"}     
+    "OpenAI o1": {"provider": "openai", "model": "o1"},
+    AUTO_MODEL: {"provider": "auto", "model": "auto"}
 }
 
+# Cheap model used for background title generation
+TITLE_MODEL = "gpt-4o-mini"
+
 # Initialize session state variables
-if "chats" not in st.session_state:
+# Reload chats whenever another process (or the maintenance worker) changed them
+current_chats_version = chats_version()
+if "chats" not in st.session_state or st.session_state.get("chats_version") != current_chats_version:
     st.session_state.chats = load_chats()
+    st.session_state.chats_version = current_chats_version
 
 if "current_chat_id" not in st.session_state:
     st.session_state.current_chat_id = None
@@ -227,6 +245,9 @@ if "current_chat_id" not in st.session_state:
 if "model" not in st.session_state:
     st.session_state.model = list(MODELS.keys())[0]
 
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
+
 # Check authentication if enabled
 if auth_enabled and not check_password():
     st.stop()  # Stop execution if authentication fails
@@ -240,22 +261,43 @@ if not set_usage_quota():
 def create_new_chat():
     chat_id = str(uuid.uuid4())
     timestamp = format_timestamp()
-    st.session_state.chats[chat_id] = {
+    chat = {
         "id": chat_id,
         "title": f"New Chat ({timestamp})",
         "messages": [],
         "created_at": timestamp
     }
+    save_chat(chat)
+    st.session_state.chats[chat_id] = chat
     st.session_state.current_chat_id = chat_id
-    save_chats(st.session_state.chats)
     return chat_id
 
+# Function to save a new exchange to the latest stored copy of a chat, so
+# changes made by other processes while waiting for the answer are kept
+@handle_error
+def save_chat_exchange(current_chat, new_messages):
+    def add_exchange(chat):
+        chat["messages"].extend(new_messages)
+        # Update chat title if it's the first message
+        if len(chat["messages"]) == 2:  # After first exchange (user + assistant)
+            # Use the first words right away; a generated title replaces it in the background
+            chat["title"] = get_chat_title_from_content(chat["messages"][0]["content"])
+    
+    saved_chat = update_chat(current_chat["id"], add_exchange)
+    if saved_chat is None:
+        # The chat was removed elsewhere in the meantime; store it again
+        saved_chat = {key: value for key, value in current_chat.items() if key != "version"}
+        saved_chat["messages"] = current_chat["messages"][:-len(new_messages)]
+        add_exchange(saved_chat)
+        save_chat(saved_chat)
+    st.session_state.chats[saved_chat["id"]] = saved_chat
+    return saved_chat
+
 # Function to get chat response from OpenAI
 @api_error_handler("openai")
-def get_openai_response(messages, model):
+def get_openai_response(messages, model, usage_key=None):
     # Track API usage
-    if "api_calls_today" in st.session_state:
-        st.session_state.api_calls_today += 1
+    record_api_call(usage_key)
         
     # Check if model is one of the newer models that doesn't support temperature
     o_models = ["o1", "o1-mini", "o3-mini"]
@@ -277,8 +319,7 @@ def get_openai_response(messages, model):
 @api_error_handler("anthropic")
 def get_anthropic_response(messages, model):
     # Track API usage
-    if "api_calls_today" in st.session_state:
-        st.session_state.api_calls_today += 1
+    record_api_call()
         
     # Convert messages to Anthropic format
     anthropic_messages = []
@@ -297,7 +338,8 @@ def get_anthropic_response(messages, model):
 
 # Function to get chat response
 @handle_error
-def get_chat_response(messages, model_info):
+def get_chat_response(messages, model_name):
+    model_info = MODELS[model_name]
     provider = model_info["provider"]
     model = model_info["model"]
     
@@ -315,7 +357,7 @@ def get_chat_response(messages, model_info):
             except Exception as e:
                 error_msg = str(e)
                 if "model_not_found" in error_msg or "does not exist" in error_msg:
-                    return f"Error: The model '{model}' is not available or you don't have access to it. Please select a different model."
+                    raise ModelNotAvailableError(f"The model '{model}' is not available or you don't have access to it. Please select a different model.")
                 raise
         elif provider == "anthropic":
             try:
@@ -323,13 +365,87 @@ def get_chat_response(messages, model_info):
             except Exception as e:
                 error_msg = str(e)
                 if "model not found" in error_msg.lower() or "does not exist" in error_msg.lower():
-                    return f"Error: The model '{model}' is not available or you don't have access to it. Please select a different model."
+                    raise ModelNotAvailableError(f"The model '{model}' is not available or you don't have access to it. Please select a different model.")
                 raise
         else:
             raise ModelNotAvailableError(f"Provider {provider} not supported")
     except Exception as e:
+        # Errors are shown in the chat, so record their class for the audit log here
+        log_event(f"Chat request failed: {str(e)}", level=logging.ERROR, model=model_name, error_class=type(e).__name__)
         return f"Error: {str(e)}"
 
+# Function to list the models whose provider API key is configured, cheapest first
+def get_available_models():
+    configured = {
+        "openai": bool(os.getenv("OPENAI_API_KEY")),
+        "anthropic": bool(os.getenv("ANTHROPIC_API_KEY"))
+    }
+    return [name for name, info in MODELS.items() if configured.get(info["provider"])]
+
+# Function to get a chat response and record the model's latency
+def get_timed_response(messages, model_name, category):
+    start_time = time.perf_counter()
+    response = get_chat_response(messages, model_name)
+    latency = time.perf_counter() - start_time
+    
+    # Fast failures would skew the per-model averages used for routing
+    if not is_error_response(response):
+        record_latency(model_name, latency, category)
+    return response, latency
+
+# Function to route a prompt to the cheapest adequate model
+def get_routed_response(messages):
+    available_models = get_available_models()
+    model_name, route = route_prompt(messages[-1]["content"], available_models)
+    response, latency = get_timed_response(messages, model_name, route)
+    escalated = False
+    
+    # Retry with a stronger model if the fast answer looks inadequate
+    escalated_model = escalation_for(model_name, available_models)
+    if needs_escalation(response) and escalated_model:
+        model_name = escalated_model
+        escalated = True
+        response, escalated_latency = get_timed_response(messages, model_name, route)
+        latency += escalated_latency
+    
+    log_event(
+        "Routed chat response",
+        model=model_name,
+        route=route,
+        escalated=escalated,
+        latency=round(latency, 3),
+        latency_saved=latency_saved(latency, route),
+    )
+    return response, model_name
+
+# Function to generate a chat title with a cheap model (runs on the maintenance worker)
+def generate_chat_title(chat_id, usage_key):
+    chat = load_chat(chat_id)
+    if not chat or not chat["messages"]:
+        return
+    
+    # Titles count against the same daily quota as chat responses
+    if not is_within_quota(usage_key):
+        return
+    
+    title = get_openai_response(
+        [
+            {"role": "system", "content": "Write a short title of at most six words for a conversation that starts with the following message. Reply with the title only."},
+            {"role": "user", "content": chat["messages"][0]["content"][:2000]}
+        ],
+        TITLE_MODEL,
+        usage_key
+    ).strip().strip('"')
+    if not title:
+        return
+    
+    def set_title(chat):
+        chat["title"] = title
+    update_chat(chat_id, set_title)
+
+if openai_api_key:
+    register_task("title", generate_chat_title)
+
 # Sidebar
 with st.sidebar:
     st.title("🔆Sage: Personal AI")
@@ -355,6 +471,8 @@ with st.sidebar:
     # Chat history
     if st.session_state.chats:
         st.markdown("### History")
+        search_query = st.text_input("Search chats", key="chat_search", placeholder="Search by title or topic")
+        
         # Sort chats by creation time (newest first)
         sorted_chats = sorted(
             st.session_state.chats.items(),
@@ -362,6 +480,10 @@ with st.sidebar:
             reverse=True
         )
         
+        # Keywords are filled in by the background indexing task
+        if search_query:
+            sorted_chats = [(chat_id, chat) for chat_id, chat in sorted_chats if chat_matches_search(chat, search_query)]
+        
         # Create a container for history buttons to apply consistent styling
         history_container = st.container()
         with history_container:
@@ -380,6 +502,9 @@ if st.session_state.current_chat_id is None or st.session_state.current_chat_id
 
 current_chat = st.session_state.chats[st.session_state.current_chat_id]
 
+# Keep chats that are open in a session safe from compaction
+mark_chat_active(current_chat["id"])
+
 # Display chat title with a modern look
 st.markdown(f"<h2 style='color: black;'>{current_chat['title']}</h2>", unsafe_allow_html=True)
 st.markdown("<hr style='margin: 0.5rem 0 1.5rem 0; border-color: #e2e8f0;'>", unsafe_allow_html=True)
@@ -406,17 +531,23 @@ if prompt := st.chat_input("Type your message here..."):
     with st.chat_message("assistant", avatar="🔆"):
         with st.spinner("Thinking..."):
             messages_for_api = [{"role": m["role"], "content": m["content"]} for m in current_chat["messages"]]
-            response = get_chat_response(messages_for_api, MODELS[st.session_state.model])
-            st.markdown(response)
+            if st.session_state.model == AUTO_MODEL:
+                response, routed_model = get_routed_response(messages_for_api)
+                st.markdown(response)
+                st.caption(f"Routed to {routed_model.replace('OpenAI ', '').replace('Anthropic ', '')}")
+            else:
+                response, latency = get_timed_response(messages_for_api, st.session_state.model, classify_prompt(prompt))
+                log_event("Chat response", latency=round(latency, 3))
+                st.markdown(response)
     
     # Add assistant response to chat
     current_chat["messages"].append({"role": "assistant", "content": response})
+    saved_chat = save_chat_exchange(current_chat, current_chat["messages"][-2:])
     
-    # Update chat title if it's the first message
-    if len(current_chat["messages"]) == 2:  # After first exchange (user + assistant)
-        current_chat["title"] = get_chat_title_from_content(current_chat["messages"][0]["content"])
-    
-    # Save chats to disk
-    save_chats(st.session_state.chats)
-
-
+    # Queue follow-up work off the request path
+    if saved_chat is not None:
+        if len(saved_chat["messages"]) == 2:
+            if openai_api_key:
+                submit_task("title", saved_chat["id"], get_usage_key())
+            submit_task("compact", saved_chat["id"])
+        submit_task("index", saved_chat["id"])
@@ -6,6 +6,7 @@ import streamlit as st
 import hmac
 import json
 import datetime
+from state_store import increment_counter, get_counter
 
 def check_password():
     """Returns `True` if the user had the correct password and is an allowed user."""
@@ -25,6 +26,8 @@ def check_password():
         
         if username in allowed_users and hmac.compare_digest(password, allowed_users[username]):
             st.session_state["authenticated"] = True
+            # Remember who is signed in for the audit log
+            st.session_state["user"] = username
             # Don't store the password
             del st.session_state["password"]
             del st.session_state["username"]
@@ -53,25 +56,38 @@ def check_password():
     
     return False
 
+def get_usage_key():
+    """Returns the shared counter key for today's API calls by the current user."""
+    user = st.session_state.get("user") or st.session_state.get("session_id", "anonymous")
+    return f"api_calls:{user}:{datetime.date.today()}"
+
+def record_api_call(usage_key=None):
+    """Counts an API call against a daily quota (the current user's by default)."""
+    if usage_key is not None:
+        # Called off the script thread (e.g. by the maintenance worker)
+        increment_counter(usage_key)
+        return
+    st.session_state.api_calls_today = increment_counter(get_usage_key())
+
+def get_max_daily_calls():
+    """Returns the daily API call limit from the environment."""
+    return int(os.environ.get("MAX_DAILY_CALLS", "50"))
+
+def is_within_quota(usage_key):
+    """Returns `True` if the quota behind usage_key has calls left today."""
+    return get_counter(usage_key) < get_max_daily_calls()
+
 def set_usage_quota():
     """Sets and tracks usage quota for the current user."""
-    # Initialize usage tracking
-    if "api_calls_today" not in st.session_state:
-        st.session_state.api_calls_today = 0
-        st.session_state.last_usage_date = None
-    
-    # Reset counter if it's a new day
-    today = str(datetime.date.today())
-    if st.session_state.last_usage_date != today:
-        st.session_state.api_calls_today = 0
-        st.session_state.last_usage_date = today
+    # Read today's usage from the shared store so every worker process agrees
+    st.session_state.api_calls_today = get_counter(get_usage_key())
     
     # Get max daily calls from environment variable
-    max_daily_calls = int(os.environ.get("MAX_DAILY_CALLS", "50"))
+    max_daily_calls = get_max_daily_calls()
     
     # Check if user has exceeded quota
     if st.session_state.api_calls_today >= max_daily_calls:
         st.error(f"You've reached your daily limit of {max_daily_calls} API calls. Please try again tomorrow.")
         return False
     
-    return True 
\ No newline at end of file
+    return True
\ No newline at end of file
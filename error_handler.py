@@ -1,20 +1,139 @@
 import streamlit as st
 import logging
-import traceback
 import sys
+import os
+import json
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler(sys.stdout)
-    ]
+# Log file location and rotation settings
+# "{pid}" in LOG_FILE is replaced with the process id, so several processes
+# never write to and rotate the same file
+LOG_FILE = os.environ.get("LOG_FILE", "app.log").format(pid=os.getpid())
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+
+# Set to a TimedRotatingFileHandler interval (e.g. "midnight", "H") to rotate by
+# time instead of size; the standard library has no handler that does both
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN")
+
+# Structured fields copied from log records into the JSON audit log
+AUDIT_FIELDS = (
+    "session", "user", "model", "latency", "error_class",
+    "route", "escalated", "latency_saved",
 )
 
+class JSONFormatter(logging.Formatter):
+    """Format log records as one JSON object per line"""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in AUDIT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        traceback_text = getattr(record, "traceback", None)
+        if traceback_text:
+            entry["traceback"] = traceback_text
+        return json.dumps(entry)
+
+class ConsoleFormatter(logging.Formatter):
+    """Plain text formatter that appends the rendered traceback, if any"""
+    def format(self, record):
+        text = super().format(record)
+        traceback_text = getattr(record, "traceback", None)
+        if traceback_text:
+            text = f"{text}\n{traceback_text}"
+        return text
+
+class AuditQueueHandler(QueueHandler):
+    """Queue handler that keeps the traceback as a separate structured field"""
+    def prepare(self, record):
+        # Tracebacks can't be pickled or safely shared across threads, so render
+        # them here and hand the listener a plain record
+        traceback_text = None
+        if record.exc_info:
+            traceback_text = logging.Formatter().formatException(record.exc_info)
+        record = super().prepare(logging.makeLogRecord({
+            **record.__dict__,
+            "exc_info": None,
+            "exc_text": None,
+        }))
+        record.traceback = traceback_text
+        return record
+
+# Name given to the root logger's queue handler so setup can find it again
+AUDIT_HANDLER_NAME = "sage_audit_queue"
+
+_log_listener = None
+
+def setup_logging():
+    """Route logging through a background queue to rotating file and stdout handlers"""
+    global _log_listener
+    if _log_listener is not None:
+        return _log_listener
+
+    # Streamlit re-imports changed modules, which resets _log_listener; the
+    # handler from the first import is still on the root logger and working
+    root_logger = logging.getLogger()
+    if any(handler.get_name() == AUDIT_HANDLER_NAME for handler in root_logger.handlers):
+        return None
+
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT
+        )
+    else:
+        file_handler = RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+        )
+    file_handler.setFormatter(JSONFormatter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(
+        ConsoleFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = AuditQueueHandler(log_queue)
+    queue_handler.set_name(AUDIT_HANDLER_NAME)
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(queue_handler)
+
+    _log_listener = QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    return _log_listener
+
+setup_logging()
+
 logger = logging.getLogger("personal_chatbot")
 
+def audit_context():
+    """Collect session, user and model fields for structured log records"""
+    try:
+        return {
+            "session": st.session_state.get("session_id"),
+            "user": st.session_state.get("user"),
+            "model": st.session_state.get("model"),
+        }
+    except Exception:
+        # Outside a Streamlit script run there is no session state
+        return {}
+
+def log_event(message, level=logging.INFO, **fields):
+    """Write a structured audit record with the current session context"""
+    extra = audit_context()
+    extra.update(fields)
+    logger.log(level, message, extra=extra)
+
 class ChatBotError(Exception):
     """Base exception class for chatbot errors"""
     pass
@@ -27,6 +146,10 @@ class ModelNotAvailableError(ChatBotError):
     """Exception raised when a model is not available"""
     pass
 
+class StateConflictError(ChatBotError):
+    """Exception raised when shared state keeps changing during an update"""
+    pass
+
 def handle_error(func):
     """Decorator to handle errors in functions"""
     def wrapper(*args, **kwargs):
@@ -34,8 +157,9 @@ def handle_error(func):
             return func(*args, **kwargs)
         except Exception as e:
             error_msg = str(e)
-            stack_trace = traceback.format_exc()
-            logger.error(f"Error in {func.__name__}: {error_msg}\n{stack_trace}")
+            extra = audit_context()
+            extra["error_class"] = type(e).__name__
+            logger.error(f"Error in {func.__name__}: {error_msg}", exc_info=True, extra=extra)
             
             if isinstance(e, APIError):
                 st.error(f"API Error: {error_msg}")
@@ -62,4 +186,4 @@ def api_error_handler(provider):
                 else:
                     raise APIError(f"API error: {error_msg}")
         return wrapper
-    return decorator 
\ No newline at end of file
+    return decorator 
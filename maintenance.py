@@ -0,0 +1,149 @@
+"""
+Background chat maintenance for Sage AI
+
+Post-response work (titles, search indexing, compaction) is queued here and
+run in batches on a worker thread, off the request path. Tasks carry chat ids rather than
+session data; each handler re-reads the chat from the state store and saves
+only that chat.
+"""
+import datetime
+import queue
+import re
+import threading
+import time
+from state_store import (
+    load_chats, update_chat, delete_chat, get_counter, set_counter, delete_counter, counter_keys
+)
+from error_handler import logger
+
+# Maximum number of tasks collected into one batch
+BATCH_SIZE = 20
+
+# Seconds to wait for more tasks to join a batch
+BATCH_WAIT = 0.5
+
+# Empty chats created and last opened more than this many seconds ago are
+# removed by compaction
+COMPACT_MIN_AGE = 3600
+
+# Seconds between writes recording that a chat is still open
+ACTIVE_MARK_INTERVAL = 300
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for",
+    "from", "how", "i", "if", "in", "is", "it", "me", "my", "of", "on", "or",
+    "that", "the", "this", "to", "was", "what", "when", "where", "which", "who",
+    "why", "with", "you", "your",
+}
+
+_task_queue = queue.Queue()
+_task_handlers = {}
+_worker = None
+_worker_lock = threading.Lock()
+_active_marks = {}
+
+def register_task(name, handler):
+    """Register a handler called as handler(chat_id, usage_key)"""
+    _task_handlers[name] = handler
+
+def submit_task(name, chat_id, usage_key=None):
+    """Queue a maintenance task for a chat and make sure the worker is running
+
+    usage_key is the quota that API calls made by the task are charged to.
+    """
+    start_worker()
+    _task_queue.put((name, chat_id, usage_key))
+
+def mark_chat_active(chat_id):
+    """Record that a session has the chat open, writing at most once per interval per process"""
+    now = time.time()
+    if now - _active_marks.get(chat_id, 0) < ACTIVE_MARK_INTERVAL:
+        return
+    _active_marks[chat_id] = now
+    set_counter(f"chat_active:{chat_id}", now)
+
+def index_chat(chat_id, usage_key=None):
+    """Store the most frequent keywords of a chat for the sidebar search"""
+    def set_keywords(chat):
+        counts = {}
+        for message in chat["messages"]:
+            for word in re.findall(r"[a-z0-9]{3,}", message["content"].lower()):
+                if word not in STOP_WORDS:
+                    counts[word] = counts.get(word, 0) + 1
+        keywords = sorted(counts, key=lambda word: (-counts[word], word))[:20]
+        if chat.get("keywords") == keywords:
+            return False
+        chat["keywords"] = keywords
+        return True
+    update_chat(chat_id, set_keywords)
+
+def compact_chats(chat_id, usage_key=None):
+    """Remove stale empty chats that no session has open, and expired counters"""
+    now = time.time()
+    cutoff = datetime.datetime.fromtimestamp(now - COMPACT_MIN_AGE)
+    chats = load_chats()
+    for other_id, chat in list(chats.items()):
+        if other_id == chat_id or chat["messages"]:
+            continue
+        try:
+            created_at = datetime.datetime.fromisoformat(chat.get("created_at", ""))
+        except ValueError:
+            continue
+        if created_at >= cutoff:
+            continue
+        # Every script run marks its current chat, so a recent mark means the
+        # chat is still open in some session
+        if now - get_counter(f"chat_active:{other_id}") < COMPACT_MIN_AGE:
+            continue
+        # Skipped if the chat changed since it was loaded
+        if delete_chat(other_id, chat["version"]):
+            del chats[other_id]
+
+    # Drop activity marks of deleted chats and quota counters of past days
+    for key in counter_keys("chat_active:"):
+        if key.split(":", 1)[1] not in chats:
+            delete_counter(key)
+    today = str(datetime.date.today())
+    for key in counter_keys("api_calls:"):
+        if key.rsplit(":", 1)[1] < today:
+            delete_counter(key)
+
+register_task("index", index_chat)
+register_task("compact", compact_chats)
+
+def run_tasks(tasks):
+    """Run a batch of tasks, running each task at most once per chat"""
+    for name, chat_id, usage_key in dict.fromkeys(tasks):
+        handler = _task_handlers.get(name)
+        if handler is None:
+            logger.warning(f"Unknown maintenance task: {name}")
+            continue
+        try:
+            handler(chat_id, usage_key)
+        except Exception as e:
+            logger.error(f"Maintenance task {name} failed for chat {chat_id}: {str(e)}", exc_info=True)
+
+def _next_batch():
+    """Block for one task, then collect whatever else arrives shortly after"""
+    tasks = [_task_queue.get()]
+    while len(tasks) < BATCH_SIZE:
+        try:
+            tasks.append(_task_queue.get(timeout=BATCH_WAIT))
+        except queue.Empty:
+            break
+    return tasks
+
+def _worker_loop():
+    while True:
+        tasks = _next_batch()
+        run_tasks(tasks)
+        for _ in tasks:
+            _task_queue.task_done()
+
+def start_worker():
+    """Start the background maintenance thread once per process"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="chat-maintenance", daemon=True)
+            _worker.start()
@@ -0,0 +1,133 @@
+"""
+Smart model routing for Sage AI
+"""
+import re
+from state_store import increment_counter, get_counter
+
+# Name of the selectbox entry that enables routing
+AUTO_MODEL = "Auto (smart routing)"
+
+# Cheapest adequate models for each prompt category, in order of preference;
+# later entries cover deployments where the first provider isn't configured
+ROUTES = {
+    "simple": ["OpenAI gpt-4o-mini", "Anthropic claude-3-5-haiku-20241022"],
+    "code": ["OpenAI gpt-4o", "Anthropic claude-3-7-sonnet-20250219"],
+    "reasoning": ["OpenAI o3-mini", "Anthropic claude-3-7-sonnet-20250219"],
+    "complex": ["Anthropic claude-3-7-sonnet-20250219", "OpenAI gpt-4o"],
+}
+
+# Models to retry with when a routed answer looks inadequate, in order of preference
+ESCALATIONS = {
+    "OpenAI gpt-4o-mini": ["OpenAI gpt-4o", "Anthropic claude-3-7-sonnet-20250219"],
+    "Anthropic claude-3-5-haiku-20241022": ["Anthropic claude-3-7-sonnet-20250219", "OpenAI gpt-4o"],
+    "OpenAI gpt-4o": ["Anthropic claude-3-7-sonnet-20250219"],
+    "OpenAI o3-mini": ["OpenAI o1", "Anthropic claude-3-7-sonnet-20250219"],
+}
+
+# Model whose latency routing is measured against
+BASELINE_MODEL = "Anthropic claude-3-7-sonnet-20250219"
+
+# Prompts longer than this are treated as complex
+LONG_PROMPT_CHARS = 2000
+
+CODE_PATTERN = re.compile(
+    r"```"
+    r"|^\s*(def|class|import|const|var)\s"
+    r"|\bSELECT\b.+\bFROM\b"
+    # Dotted or snake_case calls such as os.path.join( or get_value(
+    r"|\b[A-Za-z_]\w*\.[A-Za-z_]\w*\(|\b[A-Za-z]+_\w+\("
+    # Statements like "x = 1;" or "if (ready) {" rather than prose ending in ";"
+    r"|^\s*[\w.]+\s*[=(].*[;{]\s*$",
+    re.MULTILINE,
+)
+REASONING_PATTERN = re.compile(
+    r"\b(prove|proof|step by step|derive|calculate|solve|equation|optimi[sz]e|algorithm|why does)\b",
+    re.IGNORECASE,
+)
+COMPLEX_PATTERN = re.compile(
+    r"\b(analy[sz]e|compare|essay|in detail|detailed|review|design|architecture|strategy)\b",
+    re.IGNORECASE,
+)
+ESCALATION_PATTERN = re.compile(
+    r"\b(I'?m not sure|I am not sure|I don'?t know|I cannot|I can'?t help|unable to)\b",
+    re.IGNORECASE,
+)
+
+def classify_prompt(prompt):
+    """Classify a prompt as simple, code, reasoning or complex"""
+    if len(prompt) > LONG_PROMPT_CHARS:
+        return "complex"
+    if CODE_PATTERN.search(prompt):
+        return "code"
+    if REASONING_PATTERN.search(prompt):
+        return "reasoning"
+    if COMPLEX_PATTERN.search(prompt):
+        return "complex"
+    return "simple"
+
+def route_prompt(prompt, available_models=None):
+    """Return the model name and category chosen for a prompt
+
+    available_models lists the models whose provider is configured, cheapest
+    first. If none of a category's routes is available, the cheapest
+    available model is used.
+    """
+    category = classify_prompt(prompt)
+    if available_models is None:
+        return ROUTES[category][0], category
+    for model_name in ROUTES[category]:
+        if model_name in available_models:
+            return model_name, category
+    if available_models:
+        return available_models[0], category
+    return ROUTES[category][0], category
+
+def escalation_for(model_name, available_models=None):
+    """Return the stronger model to retry with, or None if there isn't one"""
+    for escalated_model in ESCALATIONS.get(model_name, []):
+        if available_models is None or escalated_model in available_models:
+            return escalated_model
+    return None
+
+def is_error_response(response):
+    """Check whether a chat response is an error rather than an answer"""
+    return response is None or response.startswith("Error:")
+
+def needs_escalation(response):
+    """Check whether a routed answer should be retried with a stronger model"""
+    if not response or not response.strip():
+        return True
+    if is_error_response(response):
+        return False  # Retrying won't fix API or configuration errors
+    return bool(ESCALATION_PATTERN.search(response[:200]))
+
+def record_latency(model_name, seconds, category=None):
+    """Record an observed response latency for a model in the shared store
+
+    Latencies are also kept per prompt category so savings can be compared
+    against the baseline model on the same kind of prompt.
+    """
+    increment_counter(f"latency_count:{model_name}")
+    increment_counter(f"latency_total:{model_name}", seconds)
+    if category is not None:
+        increment_counter(f"latency_count:{model_name}:{category}")
+        increment_counter(f"latency_total:{model_name}:{category}", seconds)
+
+def average_latency(model_name, category=None):
+    """Return the mean observed latency for a model, or None if never used"""
+    key = model_name if category is None else f"{model_name}:{category}"
+    count = get_counter(f"latency_count:{key}")
+    if not count:
+        return None
+    return get_counter(f"latency_total:{key}") / count
+
+def latency_saved(seconds, category):
+    """Estimate seconds saved compared with the baseline model on prompts of the same category
+
+    Returns None until the baseline model has answered a prompt of that
+    category, whether picked manually or reached through routing.
+    """
+    baseline = average_latency(BASELINE_MODEL, category)
+    if baseline is None:
+        return None
+    return round(baseline - seconds, 3)
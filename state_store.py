@@ -0,0 +1,321 @@
+"""
+Shared state storage for Sage AI
+
+Chats, usage counters and cached statistics go through a state store so that
+several Streamlit processes can serve the same users. The backend is chosen
+with the STATE_BACKEND environment variable:
+
+- "file" (default): chats in chat_data/chats.json, counters in process memory
+- "sqlite": everything in one SQLite database shared by the processes on one
+  host. It runs in WAL mode, which needs shared memory, so the database must
+  be on a local disk, never on a network filesystem such as NFS or SMB.
+
+Every stored chat carries a "version" number. Saves and deletes only succeed
+when the caller's copy is still the latest one, so a stale copy can never
+overwrite newer changes made by another process or thread.
+"""
+import os
+import json
+import sqlite3
+import threading
+import utils
+from error_handler import StateConflictError
+
+DEFAULT_DB_PATH = os.path.join(utils.CHAT_DATA_DIR, "sage.db")
+
+# Number of times update_chat re-reads a chat after losing a race
+UPDATE_RETRIES = 5
+
+class FileStateStore:
+    """Single-process store backed by the JSON chat file"""
+    def __init__(self):
+        self._counters = {}
+        self._counters_lock = threading.Lock()
+
+    def load_chats(self):
+        with utils.chats_lock:
+            chats = utils.load_chats()
+        # Chats saved before versioning count as version 0
+        for chat in chats.values():
+            chat.setdefault("version", 0)
+        return chats
+
+    def load_chat(self, chat_id):
+        return self.load_chats().get(chat_id)
+
+    def save_chat(self, chat):
+        with utils.chats_lock:
+            chats = utils.load_chats()
+            stored = chats.get(chat["id"])
+            version = chat.get("version")
+            if version is None:
+                if stored is not None:
+                    return False
+            elif stored is None or stored.get("version", 0) != version:
+                return False
+            chats[chat["id"]] = dict(chat, version=(version or 0) + 1)
+            utils.save_chats(chats)
+            chat["version"] = (version or 0) + 1
+            return True
+
+    def delete_chat(self, chat_id, version):
+        with utils.chats_lock:
+            chats = utils.load_chats()
+            stored = chats.get(chat_id)
+            if stored is None or stored.get("version", 0) != version:
+                return False
+            del chats[chat_id]
+            utils.save_chats(chats)
+            return True
+
+    def chats_version(self):
+        try:
+            return os.stat(utils.CHAT_DATA_FILE).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def increment_counter(self, key, amount=1):
+        with self._counters_lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            return self._counters[key]
+
+    def get_counter(self, key):
+        with self._counters_lock:
+            return self._counters.get(key, 0)
+
+    def set_counter(self, key, value):
+        with self._counters_lock:
+            self._counters[key] = value
+
+    def delete_counter(self, key):
+        with self._counters_lock:
+            self._counters.pop(key, None)
+
+    def counter_keys(self, prefix):
+        with self._counters_lock:
+            return [key for key in self._counters if key.startswith(prefix)]
+
+class SQLiteStateStore:
+    """Multi-process store backed by a SQLite database on the local disk of one host"""
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS chats "
+                    "(id TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 1)"
+                )
+                conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('chats_version', 0)")
+                # Databases created before chats were versioned lack the column
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(chats)")]
+                if "version" not in columns:
+                    conn.execute("ALTER TABLE chats ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # A connection per call keeps the store safe to use from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _bump_chats_version(self, conn):
+        # Other processes compare this counter to know when to reload chats
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'chats_version'")
+
+    def _row_to_chat(self, data, version):
+        chat = json.loads(data)
+        chat["version"] = version
+        return chat
+
+    def load_chats(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, data, version FROM chats").fetchall()
+        finally:
+            conn.close()
+        return {chat_id: self._row_to_chat(data, version) for chat_id, data, version in rows}
+
+    def load_chat(self, chat_id):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data, version FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_chat(*row) if row else None
+
+    def save_chat(self, chat):
+        version = chat.get("version")
+        data = json.dumps({key: value for key, value in chat.items() if key != "version"})
+        conn = self._connect()
+        try:
+            with conn:
+                if version is None:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO chats (id, data, version) VALUES (?, ?, 1)",
+                        (chat["id"], data)
+                    )
+                else:
+                    cursor = conn.execute(
+                        "UPDATE chats SET data = ?, version = version + 1 WHERE id = ? AND version = ?",
+                        (data, chat["id"], version)
+                    )
+                if cursor.rowcount != 1:
+                    return False
+                self._bump_chats_version(conn)
+        finally:
+            conn.close()
+        chat["version"] = (version or 0) + 1
+        return True
+
+    def delete_chat(self, chat_id, version):
+        conn = self._connect()
+        try:
+            with conn:
+                cursor = conn.execute("DELETE FROM chats WHERE id = ? AND version = ?", (chat_id, version))
+                if cursor.rowcount != 1:
+                    return False
+                self._bump_chats_version(conn)
+        finally:
+            conn.close()
+        return True
+
+    def chats_version(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT value FROM meta WHERE key = 'chats_version'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def increment_counter(self, key, amount=1):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO counters (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                    (key, amount)
+                )
+                return conn.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def get_counter(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def set_counter(self, key, value):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO counters (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (key, value)
+                )
+        finally:
+            conn.close()
+
+    def delete_counter(self, key):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM counters WHERE key = ?", (key,))
+        finally:
+            conn.close()
+
+    def counter_keys(self, prefix):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT key FROM counters WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in rows]
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_state_store():
+    """Return the state store configured for this process"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = os.environ.get("STATE_BACKEND", "file").lower()
+            if backend == "sqlite":
+                _store = SQLiteStateStore(os.environ.get("STATE_DB_PATH", DEFAULT_DB_PATH))
+                # Import existing chats the first time the database is used
+                if not _store.load_chats():
+                    for chat in utils.load_chats().values():
+                        chat.pop("version", None)
+                        _store.save_chat(chat)
+            elif backend == "file":
+                _store = FileStateStore()
+            else:
+                raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+        return _store
+
+def load_chats():
+    """Load all chats from the shared store"""
+    return get_state_store().load_chats()
+
+def load_chat(chat_id):
+    """Load the latest stored copy of one chat, or None if it doesn't exist"""
+    return get_state_store().load_chat(chat_id)
+
+def save_chat(chat):
+    """Save one chat if it is new or unchanged since it was loaded; returns True on success"""
+    return get_state_store().save_chat(chat)
+
+def delete_chat(chat_id, version):
+    """Delete a chat if it is unchanged since it was loaded; returns True on success"""
+    return get_state_store().delete_chat(chat_id, version)
+
+def update_chat(chat_id, update):
+    """Apply update(chat) to the latest stored copy of a chat and save it
+
+    update should return False if it made no change. The chat is re-read and
+    the update re-applied whenever another writer got there first. Returns the
+    saved chat, or None if the chat doesn't exist.
+    """
+    for _ in range(UPDATE_RETRIES):
+        chat = load_chat(chat_id)
+        if chat is None:
+            return None
+        if update(chat) is False or save_chat(chat):
+            return chat
+    raise StateConflictError(f"Chat {chat_id} kept changing while it was being updated")
+
+def chats_version():
+    """Return a value that changes whenever any process modifies the chats"""
+    return get_state_store().chats_version()
+
+def increment_counter(key, amount=1):
+    """Add to a shared counter and return its new value"""
+    return get_state_store().increment_counter(key, amount)
+
+def get_counter(key):
+    """Return the current value of a shared counter"""
+    return get_state_store().get_counter(key)
+
+def set_counter(key, value):
+    """Overwrite the value of a shared counter"""
+    get_state_store().set_counter(key, value)
+
+def delete_counter(key):
+    """Remove a shared counter"""
+    get_state_store().delete_counter(key)
+
+def counter_keys(prefix):
+    """Return the keys of all shared counters starting with prefix"""
+    return get_state_store().counter_keys(prefix)
@@ -1,13 +1,22 @@
 import unittest
 import os
 import sys
+import json
+import logging
+import tempfile
 from unittest.mock import patch, MagicMock
 
 # Add the current directory to the path so we can import our modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from utils import get_chat_title_from_content, format_timestamp, ensure_data_dir
-from error_handler import APIError, ModelNotAvailableError
+from utils import get_chat_title_from_content, format_timestamp, ensure_data_dir, chat_matches_search
+import datetime
+import state_store
+from state_store import FileStateStore, SQLiteStateStore, update_chat
+from auth_config import get_usage_key, record_api_call, is_within_quota
+from maintenance import index_chat, compact_chats, mark_chat_active, run_tasks, register_task
+from router import route_prompt, escalation_for, needs_escalation, is_error_response, record_latency, average_latency, latency_saved
+from error_handler import APIError, ModelNotAvailableError, StateConflictError, JSONFormatter, AuditQueueHandler, setup_logging
 
 class TestChatBot(unittest.TestCase):
     """Test cases for the Personal AI Chat Bot"""
@@ -55,6 +64,278 @@ class TestChatBot(unittest.TestCase):
         """Test the ModelNotAvailableError class"""
         error = ModelNotAvailableError("Test error")
         self.assertEqual(str(error), "Test error")
+    
+    def test_json_formatter(self):
+        """Test that log records are written as structured JSON"""
+        record = logging.makeLogRecord({
+            "name": "personal_chatbot",
+            "levelname": "ERROR",
+            "msg": "Error in %s",
+            "args": ("create_new_chat",),
+            "model": "OpenAI gpt-4o",
+            "error_class": "APIError",
+        })
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(entry["message"], "Error in create_new_chat")
+        self.assertEqual(entry["model"], "OpenAI gpt-4o")
+        self.assertEqual(entry["error_class"], "APIError")
+        self.assertNotIn("latency", entry)
+    
+    def test_audit_queue_handler_keeps_traceback_separate(self):
+        """Test that queued records carry the traceback as its own field"""
+        try:
+            raise ValueError("bad value")
+        except ValueError:
+            record = logging.getLogger("personal_chatbot").makeRecord(
+                "personal_chatbot", logging.ERROR, __file__, 0, "Error in %s", ("test",), sys.exc_info()
+            )
+        prepared = AuditQueueHandler(None).prepare(record)
+        self.assertIsNone(prepared.exc_info)
+        self.assertEqual(prepared.getMessage(), "Error in test")
+        
+        entry = json.loads(JSONFormatter().format(prepared))
+        self.assertEqual(entry["message"], "Error in test")
+        self.assertIn("ValueError: bad value", entry["traceback"])
+    
+    def test_setup_logging_after_reimport(self):
+        """Test that setting up logging again doesn't add a second queue handler"""
+        root_logger = logging.getLogger()
+        handler_count = len(root_logger.handlers)
+        with patch('error_handler._log_listener', None):
+            self.assertIsNone(setup_logging())
+        self.assertEqual(len(root_logger.handlers), handler_count)
+    
+    def test_route_prompt(self):
+        """Test that prompts are routed to the expected model tier"""
+        self.assertEqual(route_prompt("What is the capital of France?"), ("OpenAI gpt-4o-mini", "simple"))
+        self.assertEqual(route_prompt("def add(a, b):\n    return a + b")[1], "code")
+        self.assertEqual(route_prompt("Solve the equation 2x + 3 = 7")[1], "reasoning")
+        self.assertEqual(route_prompt("Compare Python and Go in detail")[1], "complex")
+        self.assertEqual(route_prompt("word " * 500)[1], "complex")
+        self.assertEqual(route_prompt("Why does os.path.join('a', 'b') add a slash?")[1], "code")
+        self.assertEqual(route_prompt("total = price * count;")[1], "code")
+        self.assertEqual(route_prompt("if (ready) {\n  start();\n}")[1], "code")
+        
+        # Prose with brackets or semicolons is not code
+        self.assertEqual(route_prompt("What is f(x) when x is 2?")[1], "simple")
+        self.assertEqual(route_prompt("I mostly use Python(3) at work")[1], "simple")
+        self.assertEqual(route_prompt("Lunch was late today;")[1], "simple")
+    
+    def test_route_prompt_with_one_provider(self):
+        """Test that routing only picks models whose provider is configured"""
+        anthropic_models = ["Anthropic claude-3-5-haiku-20241022", "Anthropic claude-3-7-sonnet-20250219"]
+        self.assertEqual(route_prompt("What is the capital of France?", anthropic_models)[0], "Anthropic claude-3-5-haiku-20241022")
+        self.assertEqual(route_prompt("def add(a, b):\n    return a + b", anthropic_models)[0], "Anthropic claude-3-7-sonnet-20250219")
+        self.assertEqual(route_prompt("Solve the equation 2x + 3 = 7", anthropic_models)[0], "Anthropic claude-3-7-sonnet-20250219")
+        self.assertEqual(escalation_for("Anthropic claude-3-5-haiku-20241022", anthropic_models), "Anthropic claude-3-7-sonnet-20250219")
+        self.assertIsNone(escalation_for("Anthropic claude-3-7-sonnet-20250219", anthropic_models))
+        
+        # Without a preferred route available, the cheapest configured model is used
+        self.assertEqual(route_prompt("Compare Python and Go in detail", ["OpenAI o1-mini"])[0], "OpenAI o1-mini")
+        self.assertEqual(escalation_for("OpenAI gpt-4o-mini", ["OpenAI gpt-4o-mini"]), None)
+    
+    def test_needs_escalation(self):
+        """Test the needs_escalation function"""
+        self.assertTrue(needs_escalation(None))
+        self.assertTrue(needs_escalation("I'm not sure what you are asking."))
+        self.assertFalse(needs_escalation("Paris is the capital of France."))
+        self.assertFalse(needs_escalation("Error: OpenAI API key not found."))
+        self.assertTrue(is_error_response(None))
+        self.assertTrue(is_error_response("Error: OpenAI API key not found."))
+        self.assertFalse(is_error_response("Paris is the capital of France."))
+    
+    def test_record_latency(self):
+        """Test that observed latencies are averaged per model"""
+        with patch('state_store._store', FileStateStore()):
+            self.assertIsNone(average_latency("test-model"))
+            record_latency("test-model", 1.0)
+            record_latency("test-model", 3.0)
+            self.assertEqual(average_latency("test-model"), 2.0)
+    
+    def test_latency_saved(self):
+        """Test that savings are measured against the baseline model on the same category"""
+        with patch('state_store._store', FileStateStore()):
+            self.assertIsNone(latency_saved(1.0, "simple"))
+            
+            # Complex prompts don't set the baseline for simple ones
+            record_latency("Anthropic claude-3-7-sonnet-20250219", 10.0, "complex")
+            self.assertIsNone(latency_saved(1.0, "simple"))
+            self.assertEqual(latency_saved(4.0, "complex"), 6.0)
+            
+            record_latency("Anthropic claude-3-7-sonnet-20250219", 3.0, "simple")
+            self.assertEqual(latency_saved(1.0, "simple"), 2.0)
+            self.assertEqual(average_latency("Anthropic claude-3-7-sonnet-20250219"), 6.5)
+    
+    def test_compact_chats(self):
+        """Test that only stale empty chats no session has open are removed"""
+        with tempfile.TemporaryDirectory() as temp_dir, \
+             patch('utils.CHAT_DATA_DIR', temp_dir), \
+             patch('utils.CHAT_DATA_FILE', os.path.join(temp_dir, "chats.json")), \
+             patch('state_store._store', FileStateStore()), \
+             patch.dict('maintenance._active_marks', clear=True):
+            for chat in [
+                {"id": "old", "messages": [], "created_at": "2020-01-01 00:00:00"},
+                {"id": "new", "messages": [], "created_at": format_timestamp()},
+                {"id": "used", "messages": [{"role": "user", "content": "Hi"}], "created_at": "2020-01-01 00:00:00"},
+                {"id": "current", "messages": [], "created_at": "2020-01-01 00:00:00"},
+                {"id": "open", "messages": [], "created_at": "2020-01-01 00:00:00"},
+            ]:
+                state_store.save_chat(chat)
+            mark_chat_active("open")
+            state_store.set_counter("chat_active:old", 1.0)
+            state_store.set_counter("api_calls:alice:2020-01-01", 5)
+            state_store.set_counter(f"api_calls:alice:{datetime.date.today()}", 5)
+            compact_chats("current")
+            self.assertEqual(sorted(state_store.load_chats()), ["current", "new", "open", "used"])
+            
+            # Counters of deleted chats and past days are removed too
+            self.assertEqual(state_store.counter_keys("chat_active:"), ["chat_active:open"])
+            self.assertEqual(state_store.counter_keys("api_calls:"), [f"api_calls:alice:{datetime.date.today()}"])
+    
+    def test_mark_chat_active_is_throttled(self):
+        """Test that repeated reruns don't write the active mark every time"""
+        with patch.dict('maintenance._active_marks', clear=True), \
+             patch('maintenance.set_counter') as mock_set_counter:
+            mark_chat_active("1")
+            mark_chat_active("1")
+            mark_chat_active("2")
+            self.assertEqual(mock_set_counter.call_count, 2)
+    
+    def test_index_chat(self):
+        """Test that chat keywords are stored for the sidebar search"""
+        with tempfile.TemporaryDirectory() as temp_dir, \
+             patch('utils.CHAT_DATA_DIR', temp_dir), \
+             patch('utils.CHAT_DATA_FILE', os.path.join(temp_dir, "chats.json")), \
+             patch('state_store._store', FileStateStore()):
+            state_store.save_chat({"id": "1", "title": "Baking", "messages": [
+                {"role": "user", "content": "How do I bake sourdough bread?"},
+                {"role": "assistant", "content": "Sourdough bread needs a starter."}
+            ]})
+            index_chat("1")
+            chat = state_store.load_chat("1")
+            self.assertEqual(chat["keywords"][:2], ["bread", "sourdough"])
+            
+            # Unchanged keywords don't write the chat again
+            index_chat("1")
+            self.assertEqual(state_store.load_chat("1")["version"], chat["version"])
+            
+            self.assertTrue(chat_matches_search(chat, "sourdough"))
+            self.assertTrue(chat_matches_search(chat, "BAKING sour"))
+            self.assertFalse(chat_matches_search(chat, "pizza"))
+    
+    def test_run_tasks_runs_each_task_once(self):
+        """Test that duplicate tasks in a batch only run once"""
+        handler = MagicMock()
+        register_task("test_title", handler)
+        run_tasks([("test_title", "1", "key"), ("test_title", "1", "key"), ("test_title", "2", None), ("missing", "1", None)])
+        self.assertEqual([call.args for call in handler.call_args_list], [("1", "key"), ("2", None)])
+    
+    def test_sqlite_state_store(self):
+        """Test chats, versions and counters in the SQLite state store"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SQLiteStateStore(os.path.join(temp_dir, "state.db"))
+            other_store = SQLiteStateStore(store.path)
+            chat = {"id": "1", "title": "Test", "messages": []}
+            
+            self.assertTrue(store.save_chat(chat))
+            self.assertEqual(chat["version"], 1)
+            self.assertEqual(store.load_chat("1"), chat)
+            self.assertFalse(store.save_chat({"id": "1", "title": "Duplicate", "messages": []}))
+            
+            # A copy loaded by another process is stale once this one saves
+            stale_copy = other_store.load_chat("1")
+            version = store.chats_version()
+            chat["messages"].append({"role": "user", "content": "Hi"})
+            self.assertTrue(store.save_chat(chat))
+            self.assertGreater(other_store.chats_version(), version)
+            stale_copy["title"] = "Renamed"
+            self.assertFalse(other_store.save_chat(stale_copy))
+            self.assertEqual(other_store.load_chat("1")["messages"], chat["messages"])
+            
+            # Deleting needs the latest version, and a deleted chat stays deleted
+            self.assertFalse(store.delete_chat("1", 1))
+            self.assertTrue(store.delete_chat("1", chat["version"]))
+            self.assertFalse(other_store.save_chat(chat))
+            self.assertEqual(store.load_chats(), {})
+            
+            self.assertEqual(store.get_counter("api_calls"), 0)
+            store.increment_counter("api_calls")
+            self.assertEqual(other_store.increment_counter("api_calls", 2), 3)
+            other_store.set_counter("api_calls", 0)
+            self.assertEqual(store.get_counter("api_calls"), 0)
+            self.assertEqual(store.counter_keys("api_"), ["api_calls"])
+            other_store.delete_counter("api_calls")
+            self.assertEqual(store.counter_keys("api_"), [])
+    
+    def test_file_state_store(self):
+        """Test versioned saves and deletes in the JSON file state store"""
+        with tempfile.TemporaryDirectory() as temp_dir, \
+             patch('utils.CHAT_DATA_DIR', temp_dir), \
+             patch('utils.CHAT_DATA_FILE', os.path.join(temp_dir, "chats.json")):
+            store = FileStateStore()
+            self.assertIsNone(store.chats_version())
+            chat = {"id": "1", "title": "Test", "messages": []}
+            self.assertTrue(store.save_chat(chat))
+            self.assertEqual(store.load_chat("1"), chat)
+            self.assertIsNotNone(store.chats_version())
+            
+            stale_copy = store.load_chat("1")
+            chat["title"] = "Renamed"
+            self.assertTrue(store.save_chat(chat))
+            self.assertFalse(store.save_chat(stale_copy))
+            self.assertFalse(store.delete_chat("1", stale_copy["version"]))
+            self.assertTrue(store.delete_chat("1", chat["version"]))
+            self.assertEqual(store.load_chats(), {})
+            
+            self.assertEqual(store.increment_counter("api_calls", 2), 2)
+            self.assertEqual(store.get_counter("api_calls"), 2)
+            store.set_counter("api_calls", 0)
+            self.assertEqual(store.get_counter("api_calls"), 0)
+            self.assertEqual(store.counter_keys("api_"), ["api_calls"])
+            store.delete_counter("api_calls")
+            self.assertEqual(store.counter_keys("api_"), [])
+    
+    def test_update_chat(self):
+        """Test that update_chat re-applies changes after losing a race"""
+        with tempfile.TemporaryDirectory() as temp_dir, \
+             patch('utils.CHAT_DATA_DIR', temp_dir), \
+             patch('utils.CHAT_DATA_FILE', os.path.join(temp_dir, "chats.json")), \
+             patch('state_store._store', FileStateStore()):
+            state_store.save_chat({"id": "1", "title": "Test", "messages": []})
+            
+            def add_message(chat):
+                # Another writer saves between this load and the save below
+                if not chat["messages"]:
+                    other_copy = state_store.load_chat("1")
+                    other_copy["messages"].append({"role": "user", "content": "From elsewhere"})
+                    state_store.save_chat(other_copy)
+                chat["messages"].append({"role": "user", "content": "From here"})
+            
+            chat = update_chat("1", add_message)
+            self.assertEqual([m["content"] for m in chat["messages"]], ["From elsewhere", "From here"])
+            self.assertIsNone(update_chat("missing", add_message))
+            
+            with patch('state_store.save_chat', return_value=False):
+                self.assertRaises(StateConflictError, update_chat, "1", add_message)
+    
+    def test_get_usage_key(self):
+        """Test that usage quotas are counted per signed-in user"""
+        today = str(datetime.date.today())
+        with patch('auth_config.st') as mock_st:
+            mock_st.session_state = {"user": "alice", "session_id": "abc"}
+            self.assertEqual(get_usage_key(), f"api_calls:alice:{today}")
+            mock_st.session_state = {"session_id": "abc"}
+            self.assertEqual(get_usage_key(), f"api_calls:abc:{today}")
+    
+    def test_background_calls_count_against_quota(self):
+        """Test that API calls charged to a usage key use up that quota"""
+        with patch('state_store._store', FileStateStore()), \
+             patch.dict(os.environ, {"MAX_DAILY_CALLS": "2"}):
+            self.assertTrue(is_within_quota("api_calls:alice:today"))
+            record_api_call("api_calls:alice:today")
+            record_api_call("api_calls:alice:today")
+            self.assertFalse(is_within_quota("api_calls:alice:today"))
+            self.assertTrue(is_within_quota("api_calls:bob:today"))
 
 if __name__ == "__main__":
-    unittest.main() 
\ No newline at end of file
+    unittest.main()
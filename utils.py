@@ -1,11 +1,15 @@
 import json
 import os
 import datetime
+import threading
 
 # Define the path for storing chat data
 CHAT_DATA_DIR = "chat_data"
 CHAT_DATA_FILE = os.path.join(CHAT_DATA_DIR, "chats.json")
 
+# Serializes read-modify-write of the chat file by FileStateStore
+chats_lock = threading.RLock()
+
 def ensure_data_dir():
     """Ensure the data directory exists"""
     if not os.path.exists(CHAT_DATA_DIR):
@@ -15,13 +19,17 @@ def save_chats(chats):
     """Save chats to disk"""
     ensure_data_dir()
     
-    # Convert datetime objects to strings if needed
-    serializable_chats = {}
-    for chat_id, chat in chats.items():
-        serializable_chats[chat_id] = chat
-    
-    with open(CHAT_DATA_FILE, 'w') as f:
-        json.dump(serializable_chats, f, indent=2)
+    with chats_lock:
+        # Convert datetime objects to strings if needed
+        serializable_chats = {}
+        for chat_id, chat in chats.items():
+            serializable_chats[chat_id] = chat
+        
+        # Write to a temporary file first so readers never see a partial file
+        temp_file = CHAT_DATA_FILE + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(serializable_chats, f, indent=2)
+        os.replace(temp_file, CHAT_DATA_FILE)
 
 def load_chats():
     """Load chats from disk"""
@@ -43,6 +51,15 @@ def get_chat_title_from_content(content, max_words=4):
     title_words = words[:max_words] if len(words) > max_words else words
     return " ".join(title_words) + "..."
 
+def chat_matches_search(chat, query):
+    """Check whether every word of a search query appears in a chat's title or keywords"""
+    title = chat.get("title", "").lower()
+    keywords = chat.get("keywords", [])
+    for word in query.lower().split():
+        if word not in title and not any(keyword.startswith(word) for keyword in keywords):
+            return False
+    return True
+
 def format_timestamp(timestamp_str=None):
     """Format timestamp for display"""
     if timestamp_str is None: